@@ -202,7 +202,15 @@ def check_dataset(dirname, name):
 def data(filename, nbr_features=None, verbose = False):
     ''' The 2nd parameter makes possible a using of the 3 functions of data reading (data, data_sparse, data_binary_sparse) without changing parameters'''
     if verbose: print(np.array(data_converter.file_to_array(filename)))
-    return np.array(data_converter.file_to_array(filename), dtype=float)
+    # Fast path: pandas' C parser is about an order of magnitude faster than
+    # splitting each line in Python via file_to_array, and float32 halves
+    # the memory of the returned matrix. Fall back to the old reader for
+    # anything the C parser rejects.
+    try:
+        return pd.read_csv(filename, sep=r'\s+', header=None,
+                           dtype=np.float32, engine='c').values
+    except Exception:
+        return np.array(data_converter.file_to_array(filename), dtype=float)
             
 def data_sparse (filename, nbr_features):
     ''' This function takes as argument a file representing a sparse matrix